@@ -1,26 +1,71 @@
 import os
 import re
 import json
+import functools
 import nbformat
 
-
-def parameterize_notebook(input_notebook, output_notebook, snippet=''):
+try:
+    # orjson parses notebooks considerably faster than the standard library
+    import orjson
+except ImportError:
+    orjson = None
+
+# Lines starting with def, for, while, import, from, or a comment are not parameterized
+_SKIPPED_PREFIXES = ('def ', 'for ', 'while ', 'import ', 'from ', '#')
+
+# Quoted strings directly preceded by one of these are f-, raw, byte or unicode literals and are not parameterized
+_STRING_PREFIXES = 'fFrRbBuU'
+
+# Regular expressions used on every line of every code cell are compiled once at import time
+# Matches the last alphanumeric word; the greedy prefix makes a single match land on the rightmost one
+_LAST_ALNUM_RE = re.compile(r'.*\b([a-zA-Z0-9]+)\b', re.DOTALL)
+_QUOTED_RE = re.compile(r'"(.*?)"|\'(.*?)\'')
+
+EXTENSIONS = ('pkl', 'pk', 'csv', 'joblib', 'onnx', 'ipynb')
+# Matches quoted file paths with one of the extensions above, or quoted S3 URIs
+_FILE_REF_RE = re.compile(
+    r'(["\'])((?:[^"\']+\.(?:' + '|'.join(EXTENSIONS) + r'))|s3://[^"\']+)\1')
+
+# Single alternation matched against every code line, dispatched on the name of the matching group.
+# In plain English, the alternatives match patterns like these:
+#    %env FOO=bar
+#    foo = "bar" or baz: 'qux'
+#    "data.csv" or 's3://bucket/key'
+#    s3://bucket/key (unquoted, used in bash commands)
+_LINE_RE = re.compile(
+    r"(?P<env>%env\s+(?P<env_var>[^=,]+)\s*=\s*"
+    r"(?:\"(?P<env_dq>[^\"]+)\"|'(?P<env_sq>[^']+)'|(?P<env_bare>[^\s,]+)))"
+    r"|(?P<assign>(?P<assign_var>[^=,]+)\s*(?:=|:)\s*"
+    r"(?:\"(?P<assign_dq>[^\"]+)\"|'(?P<assign_sq>[^']+)'))"
+    r"|(?P<file>(?P<file_quote>[\"'])"
+    r"(?P<file_path>[^\"']+\.(?:" + '|'.join(EXTENSIONS) + r")|s3://[^\"']+)(?P=file_quote))"
+    r"|(?P<s3>s3://[^\s]+)")
+
+
+def parameterize_notebook(input_notebook, output_notebook, snippet='', verbose=True):
     """Modify a Jupyter notebook by replacing literal assignments with parameter assignments, added as global variables tagged with `parameters` at the top of the notebook.
 
     Args:
         input_notebook (str): The path to the input Jupyter notebook.
         output_notebook (str): The path to the output Jupyter notebook.
         snippet (str, optional): The snippet to add to the output notebook. If 'nbrun', a URI snippet will be added. If any other non-empty string, the provided snippet will be added. If an empty string or not provided, no snippet will be added.
+        verbose (bool, optional): Whether to print the parameters found and a completion message. Defaults to True.
 
     """
-    param_dict = replace_literal_assignments(input_notebook, output_notebook)
-    print(json.dumps(param_dict, indent=2))
+    # Read the notebook once, apply every step in memory and write it once
+    nb = read_notebook_json(input_notebook)
+    param_dict = _replace_literal_assignments(nb)
+    if verbose:
+        print(orjson.dumps(param_dict, option=orjson.OPT_INDENT_2).decode()
+              if orjson is not None else json.dumps(param_dict, indent=2))
     if snippet.lower() == 'nbrun':
-        add_params_uri_snippet(output_notebook)
-    add_papermill_params(output_notebook, param_dict)
+        _add_params_uri_snippet(nb)
+    _add_papermill_params(nb, param_dict)
     if len(snippet):
-        add_snippet(output_notebook, param_dict, snippet=snippet)
-    print('Done')
+        _add_snippet(nb, output_notebook, param_dict, snippet=snippet)
+    write_notebook_json(nb, output_notebook)
+    if verbose:
+        print('Done')
 
 
 def replace_literal_assignments(ipynb_file, output_ipynb_file):
@@ -35,419 +80,374 @@ def replace_literal_assignments(ipynb_file, output_ipynb_file):
         dict: a dictionary of parameter names and their corresponding values
     """
     # Open the ipynb file and read its contents
-    with open(ipynb_file, 'r') as f:
-        contents = json.load(f)
-
-    param_list = []
-    param_value_dict = {}
+    contents = read_notebook_json(ipynb_file)
 
-    # Compile a regular expression to match lines starting with def, for, while, or import
-    control_flow_regex = re.compile(r'^(def|for|while|import|#|from)')
-
-    # Iterate through all cells in the notebook
-    for cell in contents['cells']:
-
-        # Check if the cell is a code cell
-        if cell['cell_type'] == 'code':
-
-            # Split the cell's source code into lines
-            lines = cell['source']
-
-            # Iterate through the lines of code
-            for i, line in enumerate(lines):
-
-                # Skip lines starting with def, for, while, or import
-                if control_flow_regex.match(line.strip()):
-                    continue
-
-                # TODO: Handle this
-                if '"""' in line:
-                    continue
-
-                new_line = line
-                if not len(line.strip()):
-                    continue
-
-                # Use the regex pattern to search for variable-value pairs
-                # In plain English, this regular expression matches patterns like these:
-                #    foo = "bar"
-                #    baz: 'qux'
-                #    hello = "world"
-                matches = re.finditer(
-                    r"([^=,]+)\s*(?:=|:)\s*(?:\"([^\"]+)\"|'([^']+)')", line, re.MULTILINE)
-
-                # Iterate through the quoted matches and get the variable and value for each pair
-                for matchNum, match in enumerate(matches, start=1):
-
-                    for groupNum in range(0, len(match.groups())):
-                        groupNum += 1
-                        if groupNum == 1 and match.group(1):
-                            variable = match.group(1)
-                        elif match.group(groupNum):
-                            value = match.group(groupNum)
-
-                    if not variable or not value:
-                        continue
-                    if not len(value.strip()):
-                        continue
-
-                    param_name, param_list, param_value_dict = process_parameter_dict(
-                        value, variable, param_list, param_value_dict)
-                    new_line = update_new_line(new_line, value, param_name)
-
-                # Iterate through notebook environment variables
-                line = new_line
-                while True:
-                    if '%env' not in line:
-                        break
-
-                    variable, value = extract_env_key_value(new_line)
-
-                    if not variable or not value:
-                        # Break here limits us to single env variable per line
-                        break
-
-                    param_name, param_list, param_value_dict = process_parameter_dict(
-                        value, variable, param_list, param_value_dict)
-                    new_line = update_new_line(
-                        new_line, value, f'${param_name}')
-                    line = new_line.replace('%env', '')
-
-                # Match files if missed above
-                files = get_file_references(new_line)
-                for file in files:
-                    filename = file[1]
-                    extension = file[2]
-                    variable = extension.upper() if len(
-                        extension) else filename[:2].upper()
-                    #param_name, param_list = add_to_param_dict(variable, param_list)
-                    #param_value_dict[param_name] = f'{filename}.{extension}'
-                    value = f'{filename}.{extension}'
-                    param_name, param_list, param_value_dict = process_parameter_dict(
-                        value, variable, param_list, param_value_dict)
-                    #new_line = update_new_line(new_line, f'{filename}.{extension}', param_name)
-                    new_line = update_new_line(new_line, value, param_name)
-
-                # Match s3_uri from a bash command
-                if new_line.startswith('!'):
-                    extracted_s3_uri = extract_s3_uri(new_line)
-                    if len(extracted_s3_uri):
-                        variable = 'S3_URI'
-                        value = extracted_s3_uri
-                        param_name, param_list, param_value_dict = process_parameter_dict(
-                            value, variable, param_list, param_value_dict)
-                        new_line = update_new_line(
-                            new_line, value, "{" + param_name + "}")
-
-                lines[i] = new_line
-
-    # Run another pass to replace quoted parameters with those already captured in param_value_dict
-    for cell in contents['cells']:
-        if cell['cell_type'] == 'code':
-            cell['source'] = update_quoted_parameters(
-                cell['source'], param_value_dict)
+    param_value_dict = _replace_literal_assignments(contents)
 
     # Write the modified contents back to the ipynb file
-    with open(output_ipynb_file, 'w') as f:
-        json.dump(contents, f)
+    write_notebook_json(contents, output_ipynb_file)
 
     return param_value_dict
 
 
-def process_parameter_dict(value: str, variable: str, param_list: list, param_value_dict: dict) -> tuple:
+def _replace_literal_assignments(contents: dict) -> dict:
     """
-    Process a parameter value and add it to a dictionary of parameters.
+    Replace literal value assignments in a notebook dictionary with parameter references, in place.
 
     Parameters:
-    - value (str): The value of the parameter to be processed.
-    - variable (str): The name of the variable associated with the parameter.
-    - param_list (list): A list of parameter names.
-    - param_value_dict (dict): A dictionary mapping parameter names to their values.
+    - contents (dict): The notebook contents.
 
     Returns:
-    - tuple: A tuple containing the parameter name, the updated list of parameter names, and the updated dictionary of parameter values.
+    - dict: A dictionary of parameter names and their corresponding values.
     """
-    temp_key = get_key(param_value_dict, value)
-    if temp_key is not None:
-        # Value already exists in dictionary. Return the existing param (temp_key) instead of updating the dict
-        param_name = temp_key
-    else:
-        param_name, param_list = add_to_param_dict(
-            get_alphanumeric(variable), param_list)
-        param_value_dict[param_name] = value.strip('"').strip("'")
-    return param_name, param_list, param_value_dict
+    param_set = set()
+    param_value_dict = {}
+    # Inverse of param_value_dict, used to look up the parameter already assigned to a value
+    value_to_param = {}
+
+    # Only the source of code cells is rewritten, so collect them once and leave
+    # markdown cells and outputs untouched
+    code_cells = [cell for cell in contents['cells']
+                  if cell['cell_type'] == 'code']
+
+    # Iterate through all code cells in the notebook and rewrite their lines,
+    # skipping cells where no line can contain a literal
+    for cell in code_cells:
+        # nbformat allows the source to be stored as a single string
+        if isinstance(cell['source'], str):
+            cell['source'] = split_source(cell['source'])
+        if not may_contain_literals(''.join(cell['source'])):
+            continue
+        cell['source'] = [_rewrite_line(line, param_set, param_value_dict, value_to_param)
+                          for line in cell['source']]
 
+    # Run another pass to replace quoted parameters with those already captured in param_value_dict
+    for cell in code_cells:
+        cell['source'] = update_quoted_parameters(
+            cell['source'], value_to_param)
 
-def update_new_line(orig_line: str, orig_text: str, new_text: str) -> str:
-    """
-    Replace a string in a line of text and remove quotes around the new string.
+    return param_value_dict
 
-    Parameters:
-    - orig_line (str): The original line of text.
-    - orig_text (str): The string to be replaced.
-    - new_text (str): The replacement string.
 
-    Returns:
-    - str: The modified line of text.
+def may_contain_literals(text: str) -> bool:
     """
-    #new_line = orig_line.replace(orig_text, new_text, 1)
-    #new_line = remove_quotes_around_string(new_line, new_text)
-    new_line = orig_line.replace(f'"{orig_text}"', new_text, 1) if f'"{orig_text}"' in orig_line else orig_line.replace(
-        f"'{orig_text}'", new_text, 1).replace(orig_text, new_text, 1)
-    return new_line
+    Check whether a piece of code can contain any of the literals matched by _LINE_RE.
 
-
-def update_quoted_parameters(nb_source_lines: list, param_value_dict: dict) -> None:
-    """
-    Update the quoted parameters in a list of lines of code with corresponding values from a dictionary.
+    Assignments, %env variables and S3 URIs all contain '=' or ':', and file references
+    need a quote and a '.' before their extension.
 
     Parameters:
-    - nb_source_lines (list): A list of lines of code to be modified.
-    - param_value_dict (dict): A dictionary mapping parameter names to their values.
+    - text (str): A line, or the joined lines of a cell.
 
     Returns:
-    - list: A list of modified lines of code.
+    - bool: False if no literal can be matched in the text.
     """
-    return [replace_quoted_string_with_dict_key(line, param_value_dict) for line in nb_source_lines]
+    return '=' in text or ':' in text or ('.' in text and ('"' in text or "'" in text))
 
 
-def replace_quoted_string_with_dict_key(line: str, value_dict: dict) -> None:
+def _is_plain_literal(text: str, quote_index: int) -> bool:
     """
-    Replace a string in a line of text with the key from a dictionary matching its value.
+    Check whether a quoted value can be replaced by a parameter reference.
+
+    Literals with a string prefix (e.g. f's3://{bucket}/{prefix}') are left as they are.
 
     Parameters:
-    - line (str): The line of text to be modified.
-    - value_dict (Dict[str, str]): A dictionary mapping keys to values.
+    - text (str): The text containing the literal.
+    - quote_index (int): The index of the opening quote in text.
 
     Returns:
-    - str: The modified line of text.
+    - bool: True if the literal can be parameterized.
     """
-    # Iterate over the items in the dictionary
-    for key, value in value_dict.items():
-        # Check if the value matches the string in the line
-        if value not in line:
-            continue
+    return quote_index == 0 or text[quote_index - 1] not in _STRING_PREFIXES
 
-        while True:
-            quoted_text = get_quoted_text(line)
-            if quoted_text is None:
-                break
-            line_temp = line
-            #print(quoted_text.strip('"').strip("'"), value)
-            if quoted_text.strip('"').strip("'") == value:
-                line = line.replace(quoted_text, key)
-            if line == line_temp:
-                break
-    return line
 
+def _rewrite_line(line: str, param_set: set, param_value_dict: dict, value_to_param: dict) -> str:
+    """
+    Replace the literal values in a line of code with parameter references, collecting the parameters found.
 
-def extract_env_key_value(line):
-    """Extracts the key and value from a line beginning with %env and separating the key and value with an = character.
-
-    Args:
-        line (str): The line to extract the key and value from.
+    Parameters:
+    - line (str): The line of code to be rewritten.
+    - param_set (set): A set of parameter names. Updated in place.
+    - param_value_dict (dict): A dictionary mapping parameter names to their values. Updated in place.
+    - value_to_param (dict): The inverse of param_value_dict. Updated in place.
 
     Returns:
-        tuple: A tuple containing the key and value.
+    - str: The rewritten line of code.
     """
-    match = re.search(
-        r"%env\s+([^=,]+)\s*=\s*(?:\"([^\"]+)\"|'([^']+)'|([^\s,]+))", line)
-    if match:
-        key = match.group(1)
-        value = match.group(2) or match.group(3) or match.group(4)
-        return key, value
-    return None, None
-
-
-def extract_s3_uri(line: str) -> str:
+    # Cheap prefilter before any regex
+    if not may_contain_literals(line):
+        return line
+
+    # Skip empty lines and lines starting with def, for, while, import, from or a comment
+    stripped = line.strip()
+    if not stripped or stripped.startswith(_SKIPPED_PREFIXES):
+        return line
+
+    # TODO: Handle this
+    if '"""' in stripped:
+        return line
+
+    # IPython expands {var} in shell commands, so values containing '{' are left alone there
+    expands_braces = line.startswith('!')
+
+    def add_parameter(value, variable):
+        param_name, _, _ = process_parameter_dict(
+            value, variable, param_set, param_value_dict, value_to_param)
+        return param_name
+
+    def replace_file_reference(file_match, file_path, quote_index):
+        if not _is_plain_literal(line, quote_index) or (expands_braces and '{' in file_path):
+            return file_match.group(0)
+        filename, extension = os.path.splitext(file_path)
+        extension = extension[1:]
+        variable = extension.upper() if len(
+            extension) else filename[:2].upper()
+        return add_parameter(file_path, variable)
+
+    # Substitute each match in place, so every literal is replaced exactly where it was found
+    def replace_match(match):
+        kind = match.lastgroup
+        text = match.group(0)
+        offset = match.start()
+
+        if kind == 'assign':
+            value_group = 'assign_dq' if match.group(
+                'assign_dq') is not None else 'assign_sq'
+            value = match.group(value_group)
+            variable = match.group('assign_var')
+            value_start = match.start(value_group) - 1
+            if len(value.strip()) and _is_plain_literal(line, value_start) and not (expands_braces and '{' in value):
+                # The quotes around the value are replaced along with it
+                replacement = add_parameter(value, variable)
+            else:
+                replacement = text[value_start - offset:]
+
+            # File references left of the assignment are consumed by this match, so replace them here
+            if '"' in variable or "'" in variable:
+                variable = _FILE_REF_RE.sub(lambda file_match: replace_file_reference(
+                    file_match, file_match.group(2), offset + file_match.start()), variable)
+
+            return variable + text[match.end('assign_var') - offset:value_start - offset] + replacement
+
+        if kind == 'env':
+            value_group = next(group for group in ('env_dq', 'env_sq', 'env_bare')
+                               if match.group(group) is not None)
+            value = match.group(value_group)
+            if '{' in value:
+                return text
+            param_name = add_parameter(value, match.group('env_var'))
+
+            value_start, value_end = match.span(value_group)
+            if value_group != 'env_bare':
+                value_start, value_end = value_start - 1, value_end + 1
+            return text[:value_start - offset] + f'${param_name}' + text[value_end - offset:]
+
+        if kind == 'file':
+            return replace_file_reference(match, match.group('file_path'), match.start('file_quote'))
+
+        # Match s3_uri from a bash command
+        if expands_braces and '{' not in match.group('s3'):
+            return "{" + add_parameter(match.group('s3'), 'S3_URI') + "}"
+        return text
+
+    # Scan the line once for assignments, %env variables, file references and S3 URIs
+    return _LINE_RE.sub(replace_match, line)
+
+
+def read_notebook_json(notebook_file: str) -> dict:
     """
-    Extract an S3 URI from a line in a Jupyter notebook.
+    Read a Jupyter notebook file as a plain dictionary, using orjson if it is installed.
 
     Parameters:
-    - line (str): The line to extract the S3 URI from.
+    - notebook_file (str): The path to the Jupyter notebook file.
 
     Returns:
-    - str: The extracted S3 URI.
+    - dict: The parsed notebook contents.
     """
-    # Compile a regular expression to match an S3 URI
-    s3_uri_regex = re.compile(r'(s3://[^\s]+)')
-
-    # Match the S3 URI in the line
-    match = s3_uri_regex.search(line)
-    if match:
-        # Return the matched S3 URI
-        return match.group(1)
-    else:
-        # Return an empty string if no S3 URI was found
-        return ''
+    if orjson is None:
+        with open(notebook_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    with open(notebook_file, 'rb') as f:
+        return orjson.loads(f.read())
 
 
-def get_key(dictionary: dict, value: any) -> any:
+def write_notebook_json(contents: dict, notebook_file: str) -> None:
     """
-    Get the key of a value in a dictionary.
+    Write a notebook dictionary to a Jupyter notebook file in nbformat's layout, without schema validation.
 
     Parameters:
-    - dictionary (dict): The dictionary to search.
-    - value (any): The value to search for.
-
-    Returns:
-    - any: The key of the value, or None if the value is not found in the dictionary.
+    - contents (dict): The notebook contents.
+    - notebook_file (str): The path to the Jupyter notebook file.
     """
-    for key, val in dictionary.items():
-        if val.strip().strip('\n') == value.strip().strip('\n'):
-            return key
-    return None
+    # nbformat's JSON writer indents by 1, sorts the keys and splits sources into lines,
+    # so the output diffs cleanly against notebooks saved by Jupyter
+    with open(notebook_file, 'w', encoding='utf-8') as f:
+        f.write(nbformat.v4.nbjson.writes(nbformat.from_dict(contents)))
+        # End the file with a newline, as nbformat.write does
+        f.write('\n')
 
 
-def add_to_param_dict(variable: str, param_list: list) -> tuple:
+def process_parameter_dict(value: str, variable: str, param_set: set, param_value_dict: dict, value_to_param: dict) -> tuple:
     """
-    Add a parameter to a list of parameters, with a unique name.
+    Process a parameter value and add it to a dictionary of parameters.
 
     Parameters:
+    - value (str): The value of the parameter to be processed.
     - variable (str): The name of the variable associated with the parameter.
-    - param_list (list): A list of parameter names.
+    - param_set (set): A set of parameter names.
+    - param_value_dict (dict): A dictionary mapping parameter names to their values.
+    - value_to_param (dict): The inverse of param_value_dict, mapping normalized values to their parameter names. Updated in place.
 
     Returns:
-    - tuple: A tuple containing the generated parameter name and the updated list of parameter names.
+    - tuple: A tuple containing the parameter name, the updated set of parameter names, and the updated dictionary of parameter values.
     """
-    param_name = f'PARAM_{variable}'
-    if param_name not in param_list:
-        param_list.append(param_name)
+    # Only the lookup key is normalized, the stored value keeps its whitespace
+    key = normalize_value(value)
+    temp_key = value_to_param.get(key)
+    if temp_key is not None:
+        # Value already exists in dictionary. Return the existing param (temp_key) instead of updating the dict
+        param_name = temp_key
     else:
-        param_name, param_list = increment_param_name(variable, param_list)
-
-    return param_name, param_list
+        param_name, param_set = add_to_param_dict(
+            get_alphanumeric(variable), param_set)
+        param_value_dict[param_name] = value.strip('"').strip("'")
+        value_to_param[key] = param_name
+    return param_name, param_set, param_value_dict
 
 
-def increment_param_name(variable, param_list=[]):
+def normalize_value(value: str) -> str:
     """
-    Generate a unique parameter name based on a variable name.
+    Strip surrounding whitespace and one pair of matching quotes from a value.
 
     Parameters:
-    - variable (str): The name of the variable associated with the parameter.
-    - param_list (list): A list of parameter names (optional).
+    - value (str): The value to be normalized.
 
     Returns:
-    - tuple: A tuple containing the generated parameter name and the updated list of parameter names.
+    - str: The normalized value.
     """
-    ctr = 2
-    while True:
-        param_name = f'PARAM_{variable}_{ctr}'
-        if param_name not in param_list:
-            param_list.append(param_name)
-            break
-        ctr += 1
-    return param_name, param_list
+    value = value.strip()
+    if len(value) >= 2 and value[0] in '"\'' and value[0] == value[-1]:
+        return value[1:-1]
+    return value
 
 
-def get_alphanumeric(variable: str) -> str:
-    """Extracts an alphanumeric variable from a string and returns it in uppercase.
+def update_quoted_parameters(nb_source_lines: list, value_to_param: dict) -> list:
+    """
+    Update the quoted parameters in a list of lines of code with corresponding parameter names from a dictionary.
 
-    Args:
-        variable (str): The string to extract the alphanumeric variable from.
+    Parameters:
+    - nb_source_lines (list): A list of lines of code to be modified.
+    - value_to_param (dict): A dictionary mapping parameter values to their names.
 
     Returns:
-        str: The extracted alphanumeric variable in uppercase.
+    - list: A list of modified lines of code.
     """
-    variable = variable.strip().strip('"').strip("'").upper()
+    # Quoted strings never span lines, so the joined cell can be scanned in one pass
+    text = ''.join(nb_source_lines)
+    if '"' not in text and "'" not in text:
+        return nb_source_lines
+    return split_source(replace_quoted_string_with_dict_key(text, value_to_param))
 
-    match_alphanumeric = re.findall(r'\b[a-zA-Z0-9]+\b', variable)
-    if len(match_alphanumeric):
-        variable = match_alphanumeric.pop().strip()
-    return variable
 
+def split_source(text: str) -> list:
+    """
+    Split the source of a cell into lines, keeping the line endings as Jupyter stores them.
 
-def remove_quotes_around_string(line, string):
-    """Remove quotes from around a given string within a line of text.
+    Unlike str.splitlines, only '\\n' ends a line, so other line separators inside strings are preserved.
 
-    Args:
-        line (str): The line of text to search.
-        string (str): The string to remove quotes from.
+    Parameters:
+    - text (str): The source of a cell.
 
     Returns:
-        str: The modified line of text with quotes removed from around the given string.
-
-    Example:
-        line = "The string 'hello' will be unquoted."
-        string = "hello"
-        remove_quotes_around_string(line, string)
-        >> "The string hello will be unquoted."
+    - list: The lines of the cell, each ending with '\\n' except for the last.
     """
-    new_line = line
-    matches = re.finditer(
-        r'(?P<quote>["\'])(?P<string>.*?)(?P=quote)', line, re.MULTILINE)
+    lines = [line + '\n' for line in text.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
 
-    for matchNum, match in enumerate(matches, start=1):
-        for groupNum in range(0, len(match.groups())):
-            groupNum += 1
-            if match.group('string') == string:
 
-                # Extract the quote type and the string
-                quote = match.group('quote')
-                matched_string = match.group('string')
+def replace_quoted_string_with_dict_key(line: str, value_to_param: dict) -> str:
+    """
+    Replace every quoted string in a line of text with the parameter name matching its value.
+
+    Parameters:
+    - line (str): The line of text to be modified.
+    - value_to_param (Dict[str, str]): A dictionary mapping normalized parameter values to their names.
 
-                # Replace the quoted string with the unquoted string
-                new_line = re.sub(
-                    f"{quote}{matched_string}{quote}", matched_string, line)
+    Returns:
+    - str: The modified line of text.
+    """
+    # Scan the quoted strings once and look each one up, leaving unknown strings untouched.
+    # The keys of value_to_param are normalized, so the quoted value is normalized the same way
+    def replace_match(match):
+        if not _is_plain_literal(line, match.start()):
+            return match.group(0)
+        value = match.group(1) if match.group(1) is not None else match.group(2)
+        return value_to_param.get(normalize_value(value), match.group(0))
 
-    return new_line
+    return _QUOTED_RE.sub(replace_match, line)
 
 
-def get_file_references(line):
+def add_to_param_dict(variable: str, param_set: set) -> tuple:
     """
-    Extract file references from a given string.
+    Add a parameter to a set of parameters, with a unique name.
 
     Parameters:
-    - line (str): The input string to extract file references from.
+    - variable (str): The name of the variable associated with the parameter.
+    - param_set (set): A set of parameter names.
 
     Returns:
-    - List[Tuple[str, str, str]]: A list of tuples containing file references. Each tuple consists of
-      a quote character (either single or double quotes), the file name, and the file extension.
-
-    Example:
-    - get_file_references('This is a file "xxx.csv" and another one 'hey.pkl'')
-      returns [('"', 'xxx', 'csv'), ("'", 'hey', 'pkl')]
-
+    - tuple: A tuple containing the generated parameter name and the updated set of parameter names.
     """
+    param_name = f'PARAM_{variable}'
+    if param_name not in param_set:
+        param_set.add(param_name)
+    else:
+        param_name, param_set = increment_param_name(variable, param_set)
 
-    extensions = ['pkl', 'pk', 'csv', 'joblib', 'onnx', 'ipynb']
-    pattern = get_pattern(extensions)
-    #pattern = r'(["\'])([^"\']+\.pkl|[^"\']+\.csv|[^"\']+\.joblib|[^"\']+\.onnx|[^"\']+\.ipynb|s3://[^"\']+)\1'
-    matches = re.findall(pattern, line)
+    return param_name, param_set
 
-    updated_matches = []
-    for match in matches:
-        quote, filepath = match
-        filename, extension = os.path.splitext(filepath)
-        updated_matches.append((quote, filename, extension[1:]))
 
-    return updated_matches
+def increment_param_name(variable: str, param_set: set = None) -> tuple:
+    """
+    Generate a unique parameter name based on a variable name.
 
+    Parameters:
+    - variable (str): The name of the variable associated with the parameter.
+    - param_set (set): A set of parameter names (optional). A new set is created if not provided.
 
-def get_pattern(extensions):
-    extensions_pattern = '|'.join([f'[^"\']+\.{ext}' for ext in extensions])
-    return r'(["\'])({extensions_pattern}|s3://[^"\']+)\1'.format(extensions_pattern=extensions_pattern).replace("[^\"']", '[^"\\\''']')
+    Returns:
+    - tuple: A tuple containing the generated parameter name and the updated set of parameter names.
+    """
+    if param_set is None:
+        param_set = set()
+    ctr = 2
+    while True:
+        param_name = f'PARAM_{variable}_{ctr}'
+        if param_name not in param_set:
+            param_set.add(param_name)
+            break
+        ctr += 1
+    return param_name, param_set
 
 
-def get_quoted_text(text: str):
-    """
-    Extract the text between quotes (either single or double quotes) from the given string.
+def get_alphanumeric(variable: str) -> str:
+    """Extracts an alphanumeric variable from a string and returns it in uppercase.
 
     Args:
-        text (str): The input string to search for quoted text.
+        variable (str): The string to extract the alphanumeric variable from.
 
     Returns:
-        Union[str, None]: The quoted text, including the quotes, if a match is found. Otherwise, returns None.
+        str: The extracted alphanumeric variable in uppercase.
     """
-    # Use a regular expression to extract the text between quotes
-    #match = re.search(r'[\'"](.*?)[\'"]', text)
-    match = re.search(r'"(.*?)"|\'(.*?)\'', text)
-    if match:
-        # Return the quoted text, including the quotes
-        return match.group(0)
-    else:
-        # If no match is found, return None
-        return None
+    variable = normalize_value(variable).upper()
+
+    match_alphanumeric = _LAST_ALNUM_RE.match(variable)
+    if match_alphanumeric:
+        variable = match_alphanumeric.group(1)
+    return variable
 
 
 def inject_code_at_top(nb, code, tag=None):
@@ -477,10 +477,23 @@ def add_papermill_params(notebook_file, params_dict):
         notebook_file (str): the path to the Jupyter notebook file
         params_dict (dict): a dictionary of parameter names and values to be added to the notebook
     """
-    # Read the notebook from a file
-    with open(notebook_file, 'r') as f:
-        nb = nbformat.read(f, as_version=4)
+    # Read the notebook from a file, skipping nbformat's schema validation of the whole notebook
+    nb = read_notebook_json(notebook_file)
+
+    _add_papermill_params(nb, params_dict)
+
+    # Write the modified notebook to a file
+    write_notebook_json(nb, notebook_file)
+
+
+def _add_papermill_params(nb, params_dict):
+    """
+    Add parameter definitions to a notebook dictionary to be used with Papermill, in place.
 
+    Parameters:
+        nb (dict): a Jupyter notebook object
+        params_dict (dict): a dictionary of parameter names and values to be added to the notebook
+    """
     # print(params_dict)
     code = ''
     for key, value in params_dict.items():
@@ -495,24 +508,23 @@ def add_papermill_params(notebook_file, params_dict):
     # Inject the code at the top of the notebook
     inject_code_at_top(nb, code, 'parameters')
 
-    # Write the modified notebook to a file
-    with open(notebook_file, 'w') as f:
-        nbformat.write(nb, f)
-
 
 def add_snippet(output_notebook, param_dict, snippet=""):
 
-    with open(output_notebook, 'r') as f:
-        nb = nbformat.read(f, as_version=4)
+    nb = read_notebook_json(output_notebook)
+
+    _add_snippet(nb, output_notebook, param_dict, snippet=snippet)
+
+    write_notebook_json(nb, output_notebook)
+
+
+def _add_snippet(nb, output_notebook, param_dict, snippet=""):
 
     if snippet.lower() == 'papermill':
         inject_code_at_top(nb, papermill_snippet(output_notebook, param_dict))
     elif snippet.lower() == 'nbrun':
         inject_code_at_top(nb, nbrun_snippet(output_notebook, param_dict))
 
-    with open(output_notebook, 'w') as f:
-        nbformat.write(nb, f)
-
 
 def add_params_uri_snippet(output_notebook):
     """Add a snippet to the top of a Jupyter notebook.
@@ -522,18 +534,39 @@ def add_params_uri_snippet(output_notebook):
         param_dict (dict): A dictionary of parameter values.
         snippet (str, optional): The type of snippet to add. If 'papermill', a papermill snippet will be added. If 'nbrun', an nbrun snippet will be added. If not provided or an empty string, no snippet will be added.
     """
-    with open(output_notebook, 'r') as f:
-        nb = nbformat.read(f, as_version=4)
+    nb = read_notebook_json(output_notebook)
+
+    _add_params_uri_snippet(nb)
+
+    write_notebook_json(nb, output_notebook)
+
+
+def _add_params_uri_snippet(nb):
+    """Add the params_uri snippet to the top of a notebook dictionary, in place.
 
+    Args:
+        nb (dict): A Jupyter notebook object.
+    """
     inject_code_at_top(nb, params_uri_snippet())
 
-    with open(output_notebook, 'w') as f:
-        nbformat.write(nb, f)
+
+@functools.lru_cache(maxsize=32)
+def _dumps_snippet_params(param_items: tuple) -> str:
+    """
+    Serialize snippet parameters, memoized so that batches reusing the same parameters format them once.
+
+    Parameters:
+    - param_items (tuple): The (name, value) pairs of the parameter dictionary, in insertion order.
+
+    Returns:
+    - str: The parameters as JSON, indented to sit inside the snippet call.
+    """
+    return json.dumps(dict(param_items), indent=8)
 
 
 def papermill_snippet(notebook_file, param_dict):
 
-    param_dict = json.dumps(param_dict, indent=8)
+    param_dict = _dumps_snippet_params(tuple(param_dict.items()))
 
     text = f"""# PAPERMILL SNIPPET
 \"\"\"
@@ -555,7 +588,7 @@ p = pm.execute_notebook(
 def nbrun_snippet(notebook_file, param_dict):
 
     param_dict['params_uri'] = ''
-    param_dict = json.dumps(param_dict, indent=8)
+    param_dict = _dumps_snippet_params(tuple(param_dict.items()))
 
     text = f"""# NBRUN SNIPPET
 \"\"\"
@@ -590,3 +623,198 @@ if params_uri != '':
     for key in params:
         print(key, params[key])
         globals()[key] = params[key]"""
+
+
+# Legacy helpers. parameterize_notebook no longer calls anything below this line; these
+# functions and the patterns they use are kept only as public API for existing callers.
+
+# Matches %env KEY=value, with the value optionally quoted
+_ENV_RE = re.compile(
+    r"%env\s+([^=,]+)\s*=\s*(?:\"([^\"]+)\"|'([^']+)'|([^\s,]+))")
+_S3_RE = re.compile(r'(s3://[^\s]+)')
+_QUOTED_STRING_RE = re.compile(
+    r'(?P<quote>["\'])(?P<string>.*?)(?P=quote)', re.MULTILINE)
+
+
+def update_new_line(orig_line: str, orig_text: str, new_text: str) -> str:
+    """
+    Replace a string in a line of text and remove quotes around the new string.
+
+    Parameters:
+    - orig_line (str): The original line of text.
+    - orig_text (str): The string to be replaced.
+    - new_text (str): The replacement string.
+
+    Returns:
+    - str: The modified line of text.
+    """
+    #new_line = orig_line.replace(orig_text, new_text, 1)
+    #new_line = remove_quotes_around_string(new_line, new_text)
+    # Try the double-quoted, then the single-quoted, then the unquoted form (e.g. %env values and S3 URIs),
+    # replacing only the first form found
+    new_line = orig_line.replace(f'"{orig_text}"', new_text, 1)
+    if new_line == orig_line:
+        new_line = orig_line.replace(f"'{orig_text}'", new_text, 1)
+    if new_line == orig_line:
+        new_line = orig_line.replace(orig_text, new_text, 1)
+    return new_line
+
+
+def extract_env_key_value(line):
+    """Extracts the key and value from a line beginning with %env and separating the key and value with an = character.
+
+    Args:
+        line (str): The line to extract the key and value from.
+
+    Returns:
+        tuple: A tuple containing the key and value.
+    """
+    match = _ENV_RE.search(line)
+    if match:
+        key = match.group(1)
+        value = match.group(2) or match.group(3) or match.group(4)
+        return key, value
+    return None, None
+
+
+def extract_s3_uri(line: str) -> str:
+    """
+    Extract an S3 URI from a line in a Jupyter notebook.
+
+    Parameters:
+    - line (str): The line to extract the S3 URI from.
+
+    Returns:
+    - str: The extracted S3 URI.
+    """
+    # Match the S3 URI in the line
+    match = _S3_RE.search(line)
+    if match:
+        # Return the matched S3 URI
+        return match.group(1)
+    else:
+        # Return an empty string if no S3 URI was found
+        return ''
+
+
+def get_key(dictionary: dict, value: any) -> any:
+    """
+    Get the key of a value in a dictionary.
+
+    Parameters:
+    - dictionary (dict): The dictionary to search.
+    - value (any): The value to search for.
+
+    Returns:
+    - any: The key of the value, or None if the value is not found in the dictionary.
+    """
+    for key, val in dictionary.items():
+        if val.strip().strip('\n') == value.strip().strip('\n'):
+            return key
+    return None
+
+
+def remove_quotes_around_string(line, string):
+    """Remove quotes from around a given string within a line of text.
+
+    Args:
+        line (str): The line of text to search.
+        string (str): The string to remove quotes from.
+
+    Returns:
+        str: The modified line of text with quotes removed from around the given string.
+
+    Example:
+        line = "The string 'hello' will be unquoted."
+        string = "hello"
+        remove_quotes_around_string(line, string)
+        >> "The string hello will be unquoted."
+    """
+    new_line = line
+    matches = _QUOTED_STRING_RE.finditer(line)
+
+    for match in matches:
+        matched_string = match.group('string')
+        if matched_string == string:
+
+            # Extract the quote type
+            quote = match.group('quote')
+
+            # Replace the quoted string with the unquoted string
+            new_line = re.sub(
+                f"{quote}{matched_string}{quote}", matched_string, line)
+
+    return new_line
+
+
+def get_file_references(line):
+    """
+    Extract file references from a given string.
+
+    Parameters:
+    - line (str): The input string to extract file references from.
+
+    Returns:
+    - List[Tuple[str, str, str]]: A list of tuples containing file references. Each tuple consists of
+      a quote character (either single or double quotes), the file name, and the file extension.
+
+    Example:
+    - get_file_references('This is a file "xxx.csv" and another one 'hey.pkl'')
+      returns [('"', 'xxx', 'csv'), ("'", 'hey', 'pkl')]
+
+    """
+    #pattern = r'(["\'])([^"\']+\.pkl|[^"\']+\.csv|[^"\']+\.joblib|[^"\']+\.onnx|[^"\']+\.ipynb|s3://[^"\']+)\1'
+    matches = _FILE_REF_RE.findall(line)
+
+    updated_matches = []
+    for match in matches:
+        quote, filepath = match
+        filename, extension = os.path.splitext(filepath)
+        updated_matches.append((quote, filename, extension[1:]))
+
+    return updated_matches
+
+
+def get_pattern(extensions):
+    """
+    Build the file reference pattern for the given extensions.
+
+    Deprecated: the pattern for EXTENSIONS is precompiled as _FILE_REF_RE and used by get_file_references.
+
+    Parameters:
+    - extensions (Iterable[str]): The file extensions to match, without the leading dot.
+
+    Returns:
+    - str: A pattern matching a quote, a file path with one of the extensions or an S3 URI, and the same quote.
+    """
+    return r'(["\'])((?:[^"\']+\.(?:' + '|'.join(extensions) + r'))|s3://[^"\']+)\1'
+
+
+def get_quoted_text(text: str):
+    """
+    Extract the text between quotes (either single or double quotes) from the given string.
+
+    Args:
+        text (str): The input string to search for quoted text.
+
+    Returns:
+        Union[str, None]: The quoted text, including the quotes, if a match is found. Otherwise, returns None.
+    """
+    # Find the leftmost quote with a matching closing quote on the same line, using str.find instead of a regex
+    start = 0
+    while True:
+        double_quote = text.find('"', start)
+        single_quote = text.find("'", start)
+        if double_quote < 0 and single_quote < 0:
+            # If no match is found, return None
+            return None
+        if single_quote < 0 or 0 <= double_quote < single_quote:
+            opening = double_quote
+        else:
+            opening = single_quote
+
+        closing = text.find(text[opening], opening + 1)
+        if closing >= 0 and text.find('\n', opening + 1, closing) < 0:
+            # Return the quoted text, including the quotes
+            return text[opening:closing + 1]
+        start = opening + 1